@@ -2,11 +2,10 @@ import os
 import asyncio
 import json
 import logging
-import base64
+import binascii
 import traceback
-import audioop  # Only needed for Twilio (Python 3.12 or lower)
 from datetime import datetime
-import pytz
+from zoneinfo import ZoneInfo
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request, Response
@@ -14,11 +13,24 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.responses import HTMLResponse
 from dotenv import load_dotenv
 
+# Fast JSON for the per-frame hot path, stdlib fallback if orjson is missing
+try:
+    import orjson
+    json_loads = orjson.loads
+    def json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode('utf-8')
+except ImportError:
+    json_loads = json.loads
+    json_dumps = json.dumps
+
 # Twilio - for phone support
 from twilio.twiml.voice_response import VoiceResponse, Connect, Stream
 
 # Import our real estate tools
-from real_estate_tools import search_properties, get_property_details, REAL_ESTATE_TOOLS
+from real_estate_tools import search_properties, get_property_details, aclose_http_client, REAL_ESTATE_TOOLS
+
+# Twilio audio transcoding (Mulaw 8k <-> PCM16 24k)
+from audio_transcoding import Resampler24k8k
 
 # SDK Imports
 from azure.ai.voicelive.aio import connect
@@ -42,27 +54,78 @@ AZURE_ENDPOINT = os.getenv("AZURE_VOICELIVE_ENDPOINT")
 AZURE_KEY = os.getenv("AZURE_VOICELIVE_API_KEY")
 AZURE_MODEL = os.getenv("AZURE_VOICELIVE_MODEL", "gpt-4o-realtime")
 
+# Verbose per-event logging on the audio path (off in production)
+DEBUG = os.getenv("VOICE_AGENT_DEBUG", "false").lower() == "true"
+
+# Browser binary frame tags (first byte of every binary WebSocket message)
+BROWSER_AUDIO_TAG = b"\x01"
+BROWSER_CLEAR_AUDIO_TAG = b"\x02"
+
+# Twilio sends 20 ms frames; coalesce up to 80 ms of PCM16 24k per append
+TWILIO_BATCH_BYTES = 3840
+
+# Concurrent tool calls per session (bounds load on Azure Search)
+TOOL_WORKERS = 2
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 log = logging.getLogger("voice-agent")
 
 # --- Step 1: Global Context & Background Worker ---
 
+DOHA_TZ = ZoneInfo('Asia/Qatar')
+
 GLOBAL_CONTEXT = {
     "display_date": "",
     "iso_date": ""
 }
 
+# --- Step 2: System Instruction Cache ---
+
+def _load_base_instruction():
+    """Read the instruction template once at startup."""
+    try:
+        with open("system_instruction.md", "r", encoding="utf-8") as f:
+            return f.read()
+    except Exception as e:
+        log.error(f"Error loading system instruction: {e}")
+        return None
+
+_BASE_INSTRUCTION = _load_base_instruction()
+CACHED_INSTRUCTION = ""
+
+def refresh_system_instruction():
+    """Re-render CACHED_INSTRUCTION from the current GLOBAL_CONTEXT."""
+    global CACHED_INSTRUCTION
+    if _BASE_INSTRUCTION is None:
+        # Fallback to a minimal instruction if file read failed at startup
+        CACHED_INSTRUCTION = f"You are Sara, a real estate consultant at Ezdan Real Estate. Today is {GLOBAL_CONTEXT['display_date']}."
+        return
+
+    # Inject dynamic context
+    CACHED_INSTRUCTION = (
+        _BASE_INSTRUCTION
+        .replace("{GLOBAL_CONTEXT['display_date']}", GLOBAL_CONTEXT['display_date'])
+        .replace("{GLOBAL_CONTEXT['iso_date']}", GLOBAL_CONTEXT['iso_date'])
+    )
+
+def refresh_doha_context():
+    """Refresh GLOBAL_CONTEXT from the Doha clock. Returns True if the date rolled over."""
+    now_doha = datetime.now(DOHA_TZ)
+    iso_date = now_doha.date().isoformat()
+    if iso_date == GLOBAL_CONTEXT['iso_date']:
+        return False
+
+    GLOBAL_CONTEXT['display_date'] = now_doha.strftime("%A, %B %d, %Y")
+    GLOBAL_CONTEXT['iso_date'] = iso_date
+    refresh_system_instruction()
+    return True
+
 async def update_doha_context():
     """Background task to keep Doha time context fresh."""
     while True:
         try:
-            doha_tz = pytz.timezone('Asia/Qatar')
-            now_doha = datetime.now(doha_tz)
-            
-            GLOBAL_CONTEXT['display_date'] = now_doha.strftime("%A, %B %d, %Y")
-            GLOBAL_CONTEXT['iso_date'] = now_doha.strftime("%Y-%m-%d")
-            
-            log.info(f"Doha Context Updated: {GLOBAL_CONTEXT['iso_date']}")
+            if refresh_doha_context():
+                log.info(f"Doha Context Updated: {GLOBAL_CONTEXT['iso_date']}")
         except Exception as e:
             log.error(f"Error updating context: {e}")
             
@@ -70,22 +133,23 @@ async def update_doha_context():
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    log.info(f"Event loop: {type(asyncio.get_running_loop()).__module__}")
+
     # --- Step 3: Hot-Start the Context ---
     try:
-        doha_tz = pytz.timezone('Asia/Qatar')
-        now_doha = datetime.now(doha_tz)
-        GLOBAL_CONTEXT['display_date'] = now_doha.strftime("%A, %B %d, %Y")
-        GLOBAL_CONTEXT['iso_date'] = now_doha.strftime("%Y-%m-%d")
+        refresh_doha_context()
         log.info(f"Hot-Start Context: {GLOBAL_CONTEXT}")
     except Exception as e:
         log.error(f"Hot-Start Failed: {e}")
         now_utc = datetime.utcnow()
         GLOBAL_CONTEXT['display_date'] = now_utc.strftime("%A, %B %d, %Y")
         GLOBAL_CONTEXT['iso_date'] = now_utc.strftime("%Y-%m-%d")
+        refresh_system_instruction()
 
     task = asyncio.create_task(update_doha_context())
     yield
     task.cancel()
+    await aclose_http_client()
 
 app = FastAPI(lifespan=lifespan)
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -107,34 +171,18 @@ async def voice(request: Request):
     response.append(twilio_connect)
     return Response(content=str(response), media_type="application/xml")
 
-# --- HELPER: AUDIO TRANSCODING ---
-def resample_mulaw_8k_to_pcm_24k(mulaw_chunk: bytes) -> bytes:
-    """Twilio (Mulaw 8k) -> Azure (PCM16 24k)"""
-    pcm_8k = audioop.ulaw2lin(mulaw_chunk, 2)
-    pcm_24k, _ = audioop.ratecv(pcm_8k, 2, 1, 8000, 24000, None)
-    return pcm_24k
+# --- AGENT LOGIC (Browser & Twilio) ---
 
-def resample_pcm_24k_to_mulaw_8k(pcm_chunk_24k: bytes) -> bytes:
-    """Azure (PCM16 24k) -> Twilio (Mulaw 8k)"""
-    pcm_8k, _ = audioop.ratecv(pcm_chunk_24k, 2, 1, 24000, 8000, None)
-    mulaw_code = audioop.lin2ulaw(pcm_8k, 2)
-    return mulaw_code
+# Static session settings, built once and shared by every connection
+_BROWSER_VOICE = AzureStandardVoice(name="en-US-AvaMultilingualNeural", type="azure-standard", rate="0.98")
+_BROWSER_VAD = ServerVad(threshold=0.6, silence_duration_ms=400)
+_TWILIO_VOICE = AzureStandardVoice(name="en-US-AvaMultilingualNeural", type="azure-standard", rate="0.9")
+_TWILIO_VAD = ServerVad(threshold=0.9, silence_duration_ms=1000, prefix_padding_ms=300)
+_MODALITIES = [Modality.TEXT, Modality.AUDIO]
 
-# --- AGENT LOGIC (Browser & Twilio) ---
 def get_system_instruction():
-    try:
-        with open("system_instruction.md", "r", encoding="utf-8") as f:
-            base_instruction = f.read()
-            
-        # Inject dynamic context
-        final_instruction = base_instruction.replace("{GLOBAL_CONTEXT['display_date']}", GLOBAL_CONTEXT['display_date'])
-        final_instruction = final_instruction.replace("{GLOBAL_CONTEXT['iso_date']}", GLOBAL_CONTEXT['iso_date'])
-        
-        return final_instruction
-    except Exception as e:
-        log.error(f"Error loading system instruction: {e}")
-        # Fallback to a minimal instruction if file read fails
-        return f"You are Sara, a real estate consultant at Ezdan Real Estate. Today is {GLOBAL_CONTEXT['display_date']}."
+    """Return the system instruction rendered by the context worker."""
+    return CACHED_INSTRUCTION
 
 async def run_browser_agent(client_ws: WebSocket):
     """Refactored logic for Browser (PCM16 24k direct)."""
@@ -149,15 +197,18 @@ async def run_browser_agent(client_ws: WebSocket):
             log.info("Azure Connected (Browser Session).")
 
             session_config = RequestSession(
-                modalities=[Modality.TEXT, Modality.AUDIO],
-                voice=AzureStandardVoice(name="en-US-AvaMultilingualNeural", type="azure-standard", rate="0.98"), 
+                modalities=_MODALITIES,
+                voice=_BROWSER_VOICE,
                 instructions=system_instruction,
                 tools=REAL_ESTATE_TOOLS,
                 input_audio_format=InputAudioFormat.PCM16,
                 output_audio_format=OutputAudioFormat.PCM16,
-                turn_detection=ServerVad(threshold=0.6, silence_duration_ms=400)
+                turn_detection=_BROWSER_VAD
             )
             await connection.session.update(session=session_config)
+
+            # Tool calls are queued and drained by a bounded worker pool
+            tool_queue = asyncio.Queue()
             
             # Trigger Greeting (Wait for Start)
             start_event = asyncio.Event()
@@ -171,7 +222,7 @@ async def run_browser_agent(client_ws: WebSocket):
                 try:
                     while True:
                         data = await client_ws.receive_text()
-                        message = json.loads(data)
+                        message = json_loads(data)
                         if message['type'] == 'start':
                             start_event.set()
                         elif message['type'] == 'audio' and message['payload']:
@@ -201,22 +252,29 @@ async def run_browser_agent(client_ws: WebSocket):
                     elif event_type == ServerEventType.RESPONSE_AUDIO_DELTA:
                         delta = getattr(event, 'delta', b'')
                         if delta:
-                            encoded = base64.b64encode(delta).decode('utf-8')
-                            await client_ws.send_json({"type": "audio", "payload": encoded})
+                            # Raw PCM16 24k in a binary frame - no base64, no JSON
+                            await client_ws.send_bytes(BROWSER_AUDIO_TAG + delta)
                     elif event_type == ServerEventType.INPUT_AUDIO_BUFFER_SPEECH_STARTED:
-                        log.info("🎙️ User started speaking...")
-                        await client_ws.send_json({"type": "clear_audio"})
+                        if DEBUG:
+                            log.info("🎙️ User started speaking...")
+                        await client_ws.send_bytes(BROWSER_CLEAR_AUDIO_TAG)
                         await connection.response.cancel()
                     elif event_type == ServerEventType.INPUT_AUDIO_BUFFER_SPEECH_STOPPED:
-                        log.info("🎙️ User stopped speaking")
+                        if DEBUG:
+                            log.info("🎙️ User stopped speaking")
                     elif event_type == ServerEventType.RESPONSE_FUNCTION_CALL_ARGUMENTS_DONE:
                         call_id = getattr(event, 'call_id', None)
                         name = getattr(event, 'name', None)
                         arguments = getattr(event, 'arguments', "{}")
                         if call_id:
-                            asyncio.create_task(handle_tool_call(connection, call_id, name, arguments))
+                            tool_queue.put_nowait((connection, call_id, name, arguments))
 
-            await asyncio.gather(forward_to_azure(), forward_to_client(), send_initial_greeting())
+            workers = [asyncio.create_task(tool_worker(tool_queue)) for _ in range(TOOL_WORKERS)]
+            try:
+                await asyncio.gather(forward_to_azure(), forward_to_client(), send_initial_greeting())
+            finally:
+                for worker in workers:
+                    worker.cancel()
 
     except Exception as e:
         log.error(f"Browser Session Error: {e}")
@@ -228,8 +286,12 @@ async def run_twilio_agent(client_ws: WebSocket):
     log.info(f"Twilio Client connected.")
     
     stream_sid = None
+    # Twilio frames preformatted once the stream SID is known
+    media_prefix = clear_message = None
     stream_start_event = asyncio.Event()
-    start_time = 0
+    # Audio gate: caller audio is dropped until the greeting has been generated
+    gate_open = False
+    resampler = Resampler24k8k()
     system_instruction = get_system_instruction()
 
     try:
@@ -238,15 +300,18 @@ async def run_twilio_agent(client_ws: WebSocket):
             log.info("Azure Connected (Twilio Session).")
 
             session_config = RequestSession(
-                modalities=[Modality.TEXT, Modality.AUDIO],
-                voice=AzureStandardVoice(name="en-US-AvaMultilingualNeural", type="azure-standard", rate="0.9"), 
+                modalities=_MODALITIES,
+                voice=_TWILIO_VOICE,
                 instructions=system_instruction,
                 tools=REAL_ESTATE_TOOLS,
                 input_audio_format=InputAudioFormat.PCM16,
                 output_audio_format=OutputAudioFormat.PCM16,
-                turn_detection=ServerVad(threshold=0.9, silence_duration_ms=1000, prefix_padding_ms=300)
+                turn_detection=_TWILIO_VAD
             )
             await connection.session.update(session=session_config)
+
+            # Tool calls are queued and drained by a bounded worker pool
+            tool_queue = asyncio.Queue()
             
             # Trigger Greeting (Wait for Stream ID)
             async def send_initial_greeting():
@@ -256,35 +321,47 @@ async def run_twilio_agent(client_ws: WebSocket):
 
             # Twilio -> Azure
             async def forward_to_azure():
-                nonlocal stream_sid, start_time
+                nonlocal stream_sid, media_prefix, clear_message
+                pcm_batch = bytearray()
                 try:
                     while True:
                         data = await client_ws.receive_text()
-                        packet = json.loads(data)
+                        packet = json_loads(data)
                         
                         if packet['event'] == 'start':
                             stream_sid = packet['start']['streamSid']
                             log.info(f"Twilio Stream Started: {stream_sid}")
+                            sid_json = json.dumps(stream_sid)
+                            media_prefix = '{"event":"media","streamSid":' + sid_json + ',"media":{"payload":"'
+                            clear_message = '{"event":"clear","streamSid":' + sid_json + '}'
                             stream_start_event.set()
-                            start_time = asyncio.get_running_loop().time()
                         
                         elif packet['event'] == 'media':
-                            # Audio Gate: Ignore first 1.2s to prevent barge-in noise
-                            if asyncio.get_running_loop().time() - start_time < 1.2:
+                            # Audio Gate: Ignore caller audio during the greeting to prevent barge-in noise
+                            if not gate_open:
                                 continue
 
                             # 1. Decode Base64 (Mulaw)
-                            mulaw_payload = base64.b64decode(packet['media']['payload'])
-                            # 2. Transcode (Mulaw 8k -> PCM 24k)
-                            pcm_24k = resample_mulaw_8k_to_pcm_24k(mulaw_payload)
-                            # 3. Encode Base64 (PCM)
-                            pcm_b64 = base64.b64encode(pcm_24k).decode('utf-8')
+                            mulaw_payload = binascii.a2b_base64(packet['media']['payload'])
+                            # 2. Transcode (Mulaw 8k -> PCM 24k) into the pending batch
+                            pcm_batch += resampler.mulaw_8k_to_pcm_24k(mulaw_payload)
+                            # Twilio streams frames continuously (silence included),
+                            # so packet arrival is the flush clock
+                            if len(pcm_batch) < TWILIO_BATCH_BYTES:
+                                continue
+
+                            # 3. Encode Base64 (PCM) - the SDK's append() only takes a base64 str
+                            pcm_b64 = binascii.b2a_base64(pcm_batch, newline=False).decode('ascii')
+                            pcm_batch.clear()
                             
                             # Send to Azure
                             await connection.input_audio_buffer.append(audio=pcm_b64)
                         
                         elif packet['event'] == 'stop':
                             log.info("Twilio Stream Stopped.")
+                            if pcm_batch:
+                                pcm_b64 = binascii.b2a_base64(pcm_batch, newline=False).decode('ascii')
+                                await connection.input_audio_buffer.append(audio=pcm_b64)
                             break
                             
                 except WebSocketDisconnect:
@@ -292,6 +369,7 @@ async def run_twilio_agent(client_ws: WebSocket):
 
             # Azure -> Twilio
             async def forward_to_client():
+                nonlocal gate_open
                 async for event in connection:
                     event_type = getattr(event, 'type', None)
                     
@@ -299,23 +377,24 @@ async def run_twilio_agent(client_ws: WebSocket):
                         delta = getattr(event, 'delta', b'')
                         if delta and stream_sid:
                             # 1. Transcode (PCM 24k -> Mulaw 8k)
-                            mulaw_chunk = resample_pcm_24k_to_mulaw_8k(delta)
-                            # 2. Encode Base64
-                            payload_b64 = base64.b64encode(mulaw_chunk).decode('utf-8')
+                            mulaw_chunk = resampler.pcm_24k_to_mulaw_8k(delta)
+                            if not mulaw_chunk:
+                                continue
+                            # 2. Encode Base64 straight from the resampler's scratch buffer
+                            payload_b64 = binascii.b2a_base64(mulaw_chunk, newline=False).decode('ascii')
                             
                             # Send 'media' event to Twilio
-                            await client_ws.send_json({
-                                "event": "media",
-                                "streamSid": stream_sid,
-                                "media": {"payload": payload_b64}
-                            })
+                            await client_ws.send_text("".join((media_prefix, payload_b64, '"}}')))
+
+                    elif event_type in (ServerEventType.RESPONSE_AUDIO_DONE, ServerEventType.RESPONSE_DONE):
+                        # First response finished (greeting) - start listening to the caller
+                        if not gate_open:
+                            gate_open = True
+                            log.info("Twilio audio gate opened.")
 
                     elif event_type == ServerEventType.INPUT_AUDIO_BUFFER_SPEECH_STARTED:
                         if stream_sid:
-                            await client_ws.send_json({
-                                "event": "clear",
-                                "streamSid": stream_sid
-                            })
+                            await client_ws.send_text(clear_message)
                         await connection.response.cancel()
 
                     elif event_type == ServerEventType.RESPONSE_FUNCTION_CALL_ARGUMENTS_DONE:
@@ -323,23 +402,37 @@ async def run_twilio_agent(client_ws: WebSocket):
                         name = getattr(event, 'name', None)
                         arguments = getattr(event, 'arguments', "{}")
                         if call_id:
-                            asyncio.create_task(handle_tool_call(connection, call_id, name, arguments))
+                            tool_queue.put_nowait((connection, call_id, name, arguments))
 
-            await asyncio.gather(forward_to_azure(), forward_to_client(), send_initial_greeting())
+            workers = [asyncio.create_task(tool_worker(tool_queue)) for _ in range(TOOL_WORKERS)]
+            try:
+                await asyncio.gather(forward_to_azure(), forward_to_client(), send_initial_greeting())
+            finally:
+                for worker in workers:
+                    worker.cancel()
 
     except Exception as e:
         log.error(f"Twilio Session Error: {e}")
         await client_ws.close()
 
 # --- SHARED TOOL HANDLER ---
+async def tool_worker(tool_queue: asyncio.Queue):
+    """Run queued tool calls for one session until cancelled."""
+    while True:
+        call = await tool_queue.get()
+        try:
+            await handle_tool_call(*call)
+        finally:
+            tool_queue.task_done()
+
 async def handle_tool_call(connection, call_id, name, arguments):
     log.info(f"="*50)
     log.info(f"🔧 TOOL CALL: {name}")
     log.info(f"📥 ARGUMENTS: {arguments}")
     
     try:
-        args = json.loads(arguments)
-        result_json = "{}"
+        args = json_loads(arguments)
+        result_data = {}
 
         if name == "search_properties":
             log.info(f"   Query: {args.get('query', 'N/A')}")
@@ -348,7 +441,7 @@ async def handle_tool_call(connection, call_id, name, arguments):
             log.info(f"   Bedrooms: {args.get('bedrooms', 'Any')}")
             log.info(f"   Price: {args.get('min_price', 'Min')}-{args.get('max_price', 'Max')} QAR")
             
-            result_json = await search_properties(
+            result_data = await search_properties(
                 query=args.get('query', ''),
                 property_type=args.get('property_type', ''),
                 location=args.get('location', ''),
@@ -358,7 +451,6 @@ async def handle_tool_call(connection, call_id, name, arguments):
             )
             
             # Log result summary
-            result_data = json.loads(result_json)
             found = result_data.get('found', 0)
             log.info(f"📊 SEARCH RESULTS: {found} properties found")
             if found > 0 and 'properties' in result_data:
@@ -370,9 +462,8 @@ async def handle_tool_call(connection, call_id, name, arguments):
         elif name == "get_property_details":
             reference_number = args.get('reference_number', '')
             log.info(f"   Reference: {reference_number}")
-            result_json = await get_property_details(reference_number)
+            result_data = await get_property_details(reference_number)
             
-            result_data = json.loads(result_json)
             if result_data.get('found'):
                 prop = result_data.get('property', {})
                 log.info(f"📊 PROPERTY FOUND: {prop.get('title', 'N/A')}")
@@ -380,7 +471,7 @@ async def handle_tool_call(connection, call_id, name, arguments):
                 log.info(f"📊 PROPERTY NOT FOUND")
         
         else:
-            result_json = json.dumps({"error": "Unknown tool called."})
+            result_data = {"error": "Unknown tool called."}
             log.warning(f"⚠️ Unknown tool: {name}")
         
         log.info(f"="*50)
@@ -389,7 +480,7 @@ async def handle_tool_call(connection, call_id, name, arguments):
             item={
                 "type": "function_call_output",
                 "call_id": call_id,
-                "output": result_json
+                "output": json_dumps(result_data)
             }
         )
         await connection.send(item)
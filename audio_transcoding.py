@@ -0,0 +1,142 @@
+"""
+Audio Transcoding for Twilio Media Streams
+==========================================
+Converts between Twilio's Mulaw 8k telephony audio and the PCM16 24k audio
+used by Azure AI Voice Live. The 1:3 / 3:1 ratio is fixed, so resampling is
+done with precomputed polyphase FIR filters whose history is kept per call.
+Everything is vectorised NumPy (the Mulaw codec is a pair of lookup tables),
+so there is no dependency on the audioop module (deprecated, and removed in
+Python 3.13).
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Sample rates
+TWILIO_SAMPLE_RATE = 8000
+AZURE_SAMPLE_RATE = 24000
+RESAMPLE_FACTOR = AZURE_SAMPLE_RATE // TWILIO_SAMPLE_RATE
+
+# Low-pass filter shared by both directions (telephony band edge)
+FILTER_TAPS = 48
+FILTER_CUTOFF_HZ = 3400
+PHASE_TAPS = FILTER_TAPS // RESAMPLE_FACTOR
+
+# Initial size of the per-call Mulaw output buffer (~1 s of 8k audio)
+MULAW_SCRATCH_SIZE = 8192
+
+
+def _design_lowpass(num_taps: int, cutoff_hz: float, sample_rate: int) -> np.ndarray:
+    """
+    Design a Hamming-windowed sinc low-pass filter.
+
+    Equivalent to scipy.signal.firwin(num_taps, cutoff_hz, fs=sample_rate),
+    normalised to unity gain at DC.
+    """
+    n = np.arange(num_taps) - (num_taps - 1) / 2
+    taps = np.sinc(2 * cutoff_hz / sample_rate * n) * np.hamming(num_taps)
+    return taps / taps.sum()
+
+
+_TAPS = _design_lowpass(FILTER_TAPS, FILTER_CUTOFF_HZ, AZURE_SAMPLE_RATE)
+
+# 8k -> 24k: column p is output phase p, reversed so that a window of the
+# last PHASE_TAPS input samples dotted with it yields output sample 3n+p.
+# Scaled by the factor to make up for the energy lost to zero-stuffing.
+_UP_BANK = np.stack(
+    [_TAPS[p::RESAMPLE_FACTOR][::-1] for p in range(RESAMPLE_FACTOR)], axis=1
+).astype(np.float32) * RESAMPLE_FACTOR
+
+# 24k -> 8k: full filter, reversed, evaluated on every third input window.
+_DOWN_TAPS = _TAPS[::-1].astype(np.float32)
+
+
+# G.711 Mulaw segment end points (14-bit magnitude domain)
+_ULAW_SEGMENT_END = np.array([0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF, 0x1FFF], dtype=np.int32)
+_ULAW_CLIP = 8159
+_ULAW_BIAS = 0x84
+
+
+def _ulaw_decode(codes: np.ndarray) -> np.ndarray:
+    """Mulaw codes -> PCM16 samples (same values as audioop.ulaw2lin)."""
+    inverted = ~codes.astype(np.int32) & 0xFF
+    magnitude = (((inverted & 0x0F) << 3) + _ULAW_BIAS) << ((inverted & 0x70) >> 4)
+    return np.where(inverted & 0x80, _ULAW_BIAS - magnitude, magnitude - _ULAW_BIAS).astype(np.int16)
+
+
+def _ulaw_encode(pcm: np.ndarray) -> np.ndarray:
+    """PCM16 samples -> Mulaw codes (same values as audioop.lin2ulaw)."""
+    value = pcm.astype(np.int32) >> 2
+    mask = np.where(value < 0, 0x7F, 0xFF)
+    magnitude = np.minimum(np.abs(value), _ULAW_CLIP) + (_ULAW_BIAS >> 2)
+    segment = np.searchsorted(_ULAW_SEGMENT_END, magnitude)
+    code = (np.minimum(segment, 7) << 4) | ((magnitude >> (segment + 1)) & 0x0F)
+    code = np.where(segment >= 8, 0x7F, code)
+    return (code ^ mask).astype(np.uint8)
+
+
+# Mulaw codec as lookup tables: 256 codes to decode, and one entry per
+# 14-bit value to encode (lin2ulaw ignores the two low bits of PCM16)
+_ULAW_DECODE_LUT = _ulaw_decode(np.arange(256, dtype=np.uint8))
+_ULAW_ENCODE_LUT = _ulaw_encode(
+    ((np.arange(0x4000, dtype=np.int32) ^ 0x2000) - 0x2000).astype(np.int16) << 2
+)
+
+
+def _to_pcm16(samples: np.ndarray) -> np.ndarray:
+    """Round and saturate filtered samples back to PCM16."""
+    return np.clip(np.rint(samples), -32768, 32767).astype(np.int16)
+
+
+class Resampler24k8k:
+    """
+    Stateful Mulaw 8k <-> PCM16 24k transcoder for a single Twilio call.
+
+    Filter history is carried over between frames (the state audioop.ratecv
+    returns and we used to discard), so consecutive 20 ms packets are
+    filtered as one continuous stream. Create one instance per session.
+    """
+
+    def __init__(self):
+        self._up_history = np.zeros(PHASE_TAPS - 1, dtype=np.float32)
+        self._down_pending = np.zeros(FILTER_TAPS - 1, dtype=np.float32)
+        self._mulaw_scratch = np.empty(MULAW_SCRATCH_SIZE, dtype=np.uint8)
+
+    def mulaw_8k_to_pcm_24k(self, mulaw_chunk: bytes) -> bytes:
+        """Twilio (Mulaw 8k) -> Azure (PCM16 24k)"""
+        if not mulaw_chunk:
+            return b""
+
+        pcm_8k = _ULAW_DECODE_LUT[np.frombuffer(mulaw_chunk, dtype=np.uint8)]
+        buffer = np.concatenate((self._up_history, pcm_8k))
+        self._up_history = buffer[len(buffer) - (PHASE_TAPS - 1):]
+
+        # One row per input sample, one column per output phase
+        pcm_24k = sliding_window_view(buffer, PHASE_TAPS) @ _UP_BANK
+        return _to_pcm16(pcm_24k.ravel()).tobytes()
+
+    def pcm_24k_to_mulaw_8k(self, pcm_chunk_24k: bytes) -> memoryview:
+        """
+        Azure (PCM16 24k) -> Twilio (Mulaw 8k)
+
+        Returns a view into a buffer reused across calls; consume it (e.g.
+        base64-encode it) before the next call.
+        """
+        pending = np.concatenate(
+            (self._down_pending, np.frombuffer(pcm_chunk_24k, dtype=np.int16))
+        )
+        output_count = (len(pending) - FILTER_TAPS) // RESAMPLE_FACTOR + 1
+        if output_count <= 0:
+            self._down_pending = pending
+            return memoryview(b"")
+
+        consumed = output_count * RESAMPLE_FACTOR
+        windows = sliding_window_view(pending, FILTER_TAPS)[:consumed:RESAMPLE_FACTOR]
+        self._down_pending = pending[consumed:]
+
+        pcm_8k = windows @ _DOWN_TAPS
+        if output_count > len(self._mulaw_scratch):
+            self._mulaw_scratch = np.empty(output_count, dtype=np.uint8)
+        mulaw_8k = self._mulaw_scratch[:output_count]
+        np.take(_ULAW_ENCODE_LUT, (_to_pcm16(pcm_8k) >> 2) & 0x3FFF, out=mulaw_8k)
+        return memoryview(mulaw_8k)
@@ -0,0 +1,42 @@
+"""
+Gunicorn Settings for the Voice Agent
+=====================================
+One uvicorn worker per CPU, each pinned to its own core, so concurrent
+calls are not serialized on a single event loop.
+"""
+
+import os
+
+bind = "0.0.0.0"
+timeout = 600
+worker_class = "uvicorn_worker.VoiceAgentWorker"
+_cpu_count = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+workers = int(os.getenv("WEB_CONCURRENCY", _cpu_count))
+
+# Per-request access logging is disabled in the worker config as well
+accesslog = None
+
+
+def pre_fork(server, worker):
+    """Pick a CPU for the new worker: the least used core among live workers."""
+    if not hasattr(os, "sched_setaffinity"):
+        return
+
+    # worker.age keeps rising across respawns, so choose from the cores in
+    # use right now rather than round-robin by age
+    usage = {cpu: 0 for cpu in sorted(os.sched_getaffinity(0))}
+    for live_worker in server.WORKERS.values():
+        cpu = getattr(live_worker, "pinned_cpu", None)
+        if cpu in usage:
+            usage[cpu] += 1
+    worker.pinned_cpu = min(usage, key=usage.get)
+
+
+def post_fork(server, worker):
+    """Pin the forked worker to the CPU chosen in pre_fork (Linux only)."""
+    cpu = getattr(worker, "pinned_cpu", None)
+    if cpu is None:
+        return
+
+    os.sched_setaffinity(0, {cpu})
+    server.log.info(f"Worker {worker.pid} pinned to CPU {cpu}")
@@ -6,8 +6,13 @@ Provides property search functionality using Azure AI Search with hybrid
 """
 
 import os
-import json
-import requests
+import re
+import asyncio
+import time
+import httpx
+from array import array
+from collections import OrderedDict
+from functools import lru_cache
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -28,6 +33,22 @@ SEARCH_API_VERSION = "2024-07-01"
 OPENAI_API_VERSION = "2024-02-01"
 EMBEDDING_DIMENSIONS = 3072
 
+# Shared HTTP/2 client for Azure AI Search and Azure OpenAI (keeps
+# connections warm and never blocks the event loop)
+_HTTP = httpx.AsyncClient(
+    http2=True,
+    timeout=15.0,
+    limits=httpx.Limits(max_connections=50, max_keepalive_connections=20)
+)
+
+# Embedding cache (voice queries repeat heavily within and across calls)
+EMBEDDING_CACHE_SIZE = 1024
+EMBEDDING_CACHE_TTL_SECONDS = 3600
+_embedding_cache = OrderedDict()
+
+# Strong references to fire-and-forget tasks until they complete
+_background_tasks = set()
+
 # Tool definitions for Azure Voice Live API
 REAL_ESTATE_TOOLS = [
     {
@@ -100,10 +121,53 @@ def _get_openai_headers():
     }
 
 
-def _generate_embedding(text: str) -> list:
+async def aclose_http_client():
+    """Close the shared HTTP client. Call once on application shutdown."""
+    await _HTTP.aclose()
+
+
+def _keep_in_background(task: asyncio.Task):
+    """Hold a reference to a task we no longer await so it runs to completion."""
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+def _get_cached_embedding(key: tuple):
+    """Return a cached embedding as a list, or None if missing or expired."""
+    entry = _embedding_cache.get(key)
+    if entry is None:
+        return None
+    
+    expires_at, embedding = entry
+    if expires_at < time.monotonic():
+        del _embedding_cache[key]
+        return None
+    
+    _embedding_cache.move_to_end(key)
+    return embedding.tolist()
+
+
+def _cache_embedding(key: tuple, embedding: list):
+    """
+    Store an embedding, evicting the least recently used entry when full.
+    
+    Vectors are kept as packed float32 (~12 KB each instead of ~100 KB of
+    Python floats), since every gunicorn worker holds its own cache.
+    """
+    _embedding_cache[key] = (time.monotonic() + EMBEDDING_CACHE_TTL_SECONDS, array('f', embedding))
+    _embedding_cache.move_to_end(key)
+    if len(_embedding_cache) > EMBEDDING_CACHE_SIZE:
+        _embedding_cache.popitem(last=False)
+
+
+async def _generate_embedding(text: str) -> list:
     """
     Generate embedding vector for text using Azure OpenAI.
     
+    Results are memoized in an LRU cache with a TTL, keyed by
+    (text, EMBEDDING_DIMENSIONS) and stored as float32; failures are not
+    cached.
+    
     Args:
         text: The text to embed
         
@@ -113,6 +177,11 @@ def _generate_embedding(text: str) -> list:
     if not OPENAI_ENDPOINT or not OPENAI_API_KEY:
         return None
     
+    cache_key = (text, EMBEDDING_DIMENSIONS)
+    cached = _get_cached_embedding(cache_key)
+    if cached is not None:
+        return cached
+    
     try:
         url = f"{OPENAI_ENDPOINT}/openai/deployments/{EMBEDDING_DEPLOYMENT}/embeddings?api-version={OPENAI_API_VERSION}"
         
@@ -121,11 +190,13 @@ def _generate_embedding(text: str) -> list:
             "dimensions": EMBEDDING_DIMENSIONS
         }
         
-        response = requests.post(url, headers=_get_openai_headers(), json=payload, timeout=10)
+        response = await _HTTP.post(url, headers=_get_openai_headers(), json=payload, timeout=10)
         
         if response.status_code == 200:
             result = response.json()
-            return result["data"][0]["embedding"]
+            embedding = result["data"][0]["embedding"]
+            _cache_embedding(cache_key, embedding)
+            return embedding
         else:
             return None
             
@@ -133,32 +204,59 @@ def _generate_embedding(text: str) -> list:
         return None
 
 
-async def search_properties(
-    query: str,
-    property_type: str = "",
-    location: str = "",
-    min_price: int = None,
-    max_price: int = None,
-    bedrooms: int = None
-) -> str:
-    """
-    Hybrid search for properties using keyword + vector search.
-    
-    Returns JSON string with search results.
+# Filter fragments for the property_type enum, built once
+_PROPERTY_TYPE_FILTERS = {
+    property_type: f"property_type eq '{property_type}'"
+    for property_type in ("Apartment", "Villa", "Commercial")
+}
+
+
+def _quote_odata(value: str) -> str:
+    """Escape a value for use inside an OData string literal."""
+    return str(value).replace("'", "''")
+
+
+def _with_vector_query(payload: dict, embedding: list) -> dict:
+    """Return a copy of a search payload with a vector query added."""
+    return {
+        **payload,
+        "vectorQueries": [
+            {
+                "kind": "vector",
+                "vector": embedding,
+                "fields": "content_vector",
+                "k": 10
+            }
+        ]
+    }
+
+
+def _optional_int(value):
+    """Convert a numeric tool argument to int, keeping None as None."""
+    return None if value is None else int(value)
+
+
+@lru_cache(maxsize=256)
+def _build_filter(property_type, location, min_price, max_price, bedrooms) -> str:
     """
-    if not SEARCH_ENDPOINT or not SEARCH_API_KEY:
-        return json.dumps({"error": "Search service not configured"})
+    Build the OData filter expression for search_properties.
     
-    url = f"{SEARCH_ENDPOINT}/indexes/{INDEX_NAME}/docs/search?api-version={SEARCH_API_VERSION}"
+    Memoized on the argument tuple, since the voice agent sends the same few
+    filter combinations over and over. Prices and bedrooms must already be
+    ints (see _optional_int).
     
-    # Build filter expressions
+    Returns the expression, or an empty string when no filter applies.
+    """
     filters = []
     
     if property_type:
-        filters.append(f"property_type eq '{property_type}'")
+        filters.append(
+            _PROPERTY_TYPE_FILTERS.get(property_type)
+            or f"property_type eq '{_quote_odata(property_type)}'"
+        )
     
     if location:
-        filters.append(f"search.ismatch('{location}', 'location')")
+        filters.append(f"search.ismatch('{_quote_odata(location)}', 'location')")
     
     if min_price is not None:
         filters.append(f"price ge {min_price}")
@@ -169,6 +267,46 @@ async def search_properties(
     if bedrooms is not None:
         filters.append(f"bedrooms eq {bedrooms}")
     
+    return " and ".join(filters)
+
+
+async def search_properties(
+    query: str,
+    property_type: str = "",
+    location: str = "",
+    min_price: int = None,
+    max_price: int = None,
+    bedrooms: int = None
+) -> dict:
+    """
+    Hybrid search for properties using keyword + vector search.
+    
+    A cached query embedding goes straight to one hybrid search. Otherwise
+    the embedding and a keyword-only search are started together; the
+    hybrid search is only issued if the embedding arrives first, otherwise
+    the keyword results are returned.
+    
+    Returns a dict with search results (serialized by the caller).
+    """
+    if not SEARCH_ENDPOINT or not SEARCH_API_KEY:
+        return {"error": "Search service not configured"}
+    
+    url = f"{SEARCH_ENDPOINT}/indexes/{INDEX_NAME}/docs/search?api-version={SEARCH_API_VERSION}"
+    
+    # Build filter expression (memoized per distinct combination). Numeric
+    # arguments come from the LLM, so coerce them to int before they reach
+    # the OData expression.
+    try:
+        filter_expression = _build_filter(
+            property_type,
+            location,
+            _optional_int(min_price),
+            _optional_int(max_price),
+            _optional_int(bedrooms)
+        )
+    except (TypeError, ValueError) as e:
+        return {"error": f"Invalid search filter: {str(e)}"}
+    
     # Build search payload - start with keyword search
     payload = {
         "search": query,
@@ -178,23 +316,40 @@ async def search_properties(
         "queryType": "simple"
     }
     
-    # Add vector search if embeddings are available
-    query_embedding = _generate_embedding(query)
-    if query_embedding:
-        payload["vectorQueries"] = [
-            {
-                "kind": "vector",
-                "vector": query_embedding,
-                "fields": "content_vector",
-                "k": 10
-            }
-        ]
-    
-    if filters:
-        payload["filter"] = " and ".join(filters)
+    if filter_expression:
+        payload["filter"] = filter_expression
     
     try:
-        response = requests.post(url, headers=_get_search_headers(), json=payload, timeout=15)
+        cached_embedding = _get_cached_embedding((query, EMBEDDING_DIMENSIONS))
+        if cached_embedding is not None:
+            # Cache hit - a single hybrid search, no race
+            response = await _HTTP.post(
+                url, headers=_get_search_headers(), json=_with_vector_query(payload, cached_embedding), timeout=15
+            )
+        else:
+            # Race the embedding against a keyword-only search so tool latency
+            # is max(embed, search) rather than embed + search
+            embedding_task = asyncio.create_task(_generate_embedding(query))
+            keyword_task = asyncio.create_task(
+                _HTTP.post(url, headers=_get_search_headers(), json=payload, timeout=15)
+            )
+            done, _ = await asyncio.wait({embedding_task, keyword_task}, return_when=asyncio.FIRST_COMPLETED)
+            
+            query_embedding = embedding_task.result() if embedding_task in done else None
+            if query_embedding:
+                # Embedding won - drop the keyword search and run a hybrid search
+                if keyword_task in done:
+                    keyword_task.exception()  # retrieve it so a failure isn't reported as unhandled
+                else:
+                    keyword_task.cancel()
+                response = await _HTTP.post(
+                    url, headers=_get_search_headers(), json=_with_vector_query(payload, query_embedding), timeout=15
+                )
+            else:
+                # Keyword results first - let the embedding finish to warm the cache
+                if not embedding_task.done():
+                    _keep_in_background(embedding_task)
+                response = await keyword_task
         
         if response.status_code == 200:
             result = response.json()
@@ -203,10 +358,10 @@ async def search_properties(
             
             # Format response for voice agent
             if not properties:
-                return json.dumps({
+                return {
                     "found": 0,
                     "message": "No properties found matching your criteria."
-                })
+                }
             
             formatted_properties = []
             for prop in properties:
@@ -220,26 +375,38 @@ async def search_properties(
                     "bathrooms": prop.get("bathrooms")
                 })
             
-            return json.dumps({
+            return {
                 "found": total_count,
                 "showing": len(formatted_properties),
                 "properties": formatted_properties
-            })
+            }
         else:
-            return json.dumps({"error": f"Search failed: {response.status_code}"})
+            return {"error": f"Search failed: {response.status_code}"}
             
     except Exception as e:
-        return json.dumps({"error": f"Search error: {str(e)}"})
+        return {"error": f"Search error: {str(e)}"}
 
 
-async def get_property_details(reference_number: str) -> str:
+def _build_prefix_query(reference_number: str) -> str:
+    """Turn 'JG-SHOP-A1' into the Lucene query 'JG* AND SHOP* AND A1*'."""
+    tokens = re.findall(r"[A-Za-z0-9]+", reference_number)
+    return " AND ".join(f"{token}*" for token in tokens)
+
+
+async def get_property_details(reference_number: str) -> dict:
     """
-    Get details of a specific property by reference number using hybrid search.
+    Get details of a specific property by reference number.
+    
+    Uses a keyword match on reference_number, with a single prefix-match
+    fallback (e.g. for a partially heard reference) if nothing is found.
+    The fallback is only used when it matches exactly one property, and any
+    result whose reference differs from the one asked for is returned with
+    "exact_match": False.
     
-    Returns JSON string with property details.
+    Returns a dict with property details (serialized by the caller).
     """
     if not SEARCH_ENDPOINT or not SEARCH_API_KEY:
-        return json.dumps({"error": "Search service not configured"})
+        return {"error": "Search service not configured"}
     
     url = f"{SEARCH_ENDPOINT}/indexes/{INDEX_NAME}/docs/search?api-version={SEARCH_API_VERSION}"
     
@@ -251,36 +418,38 @@ async def get_property_details(reference_number: str) -> str:
         "select": "id,reference_number,title,property_type,location,price,bedrooms,bathrooms,url,image_url"
     }
     
-    # Also add vector search for semantic matching
-    query_embedding = _generate_embedding(f"property reference {reference_number}")
-    if query_embedding:
-        payload["vectorQueries"] = [
-            {
-                "kind": "vector",
-                "vector": query_embedding,
-                "fields": "content_vector",
-                "k": 1
-            }
-        ]
-    
     try:
-        response = requests.post(url, headers=_get_search_headers(), json=payload, timeout=10)
+        response = await _HTTP.post(url, headers=_get_search_headers(), json=payload, timeout=10)
         
         if response.status_code == 200:
             result = response.json()
             properties = result.get("value", [])
             
+            # Fallback: prefix-match every token of the reference number, but
+            # only trust it when it narrows down to a single property
+            prefix_query = _build_prefix_query(reference_number)
+            if not properties and prefix_query:
+                fallback_payload = {**payload, "search": prefix_query, "queryType": "full", "top": 2}
+                response = await _HTTP.post(url, headers=_get_search_headers(), json=fallback_payload, timeout=10)
+                if response.status_code == 200:
+                    candidates = response.json().get("value", [])
+                    if len(candidates) == 1:
+                        properties = candidates
+            
             if not properties:
-                return json.dumps({
+                return {
                     "found": False,
                     "message": f"No property found with reference number {reference_number}"
-                })
+                }
             
             prop = properties[0]
-            return json.dumps({
+            matched_reference = prop.get("reference_number") or ""
+            exact_match = matched_reference.upper() == reference_number.strip().upper()
+            result = {
                 "found": True,
+                "exact_match": exact_match,
                 "property": {
-                    "reference": prop.get("reference_number"),
+                    "reference": matched_reference,
                     "title": prop.get("title"),
                     "type": prop.get("property_type"),
                     "location": prop.get("location"),
@@ -289,9 +458,15 @@ async def get_property_details(reference_number: str) -> str:
                     "bathrooms": prop.get("bathrooms"),
                     "url": prop.get("url")
                 }
-            })
+            }
+            if not exact_match:
+                result["message"] = (
+                    f"No exact match for reference number {reference_number}; "
+                    f"closest match is {matched_reference}. Confirm with the customer before quoting details."
+                )
+            return result
         else:
-            return json.dumps({"error": f"Lookup failed: {response.status_code}"})
+            return {"error": f"Lookup failed: {response.status_code}"}
             
     except Exception as e:
-        return json.dumps({"error": f"Lookup error: {str(e)}"})
+        return {"error": f"Lookup error: {str(e)}"}
@@ -1 +1 @@
-gunicorn --bind=0.0.0.0 --timeout 600 --worker-class uvicorn.workers.UvicornWorker app:app
+gunicorn --config gunicorn.conf.py app:app
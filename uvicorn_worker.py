@@ -0,0 +1,28 @@
+"""
+Gunicorn Worker for the Voice Agent
+===================================
+UvicornWorker tuned for long-lived audio WebSockets (Browser and Twilio).
+"""
+
+from uvicorn.workers import UvicornWorker
+
+
+class VoiceAgentWorker(UvicornWorker):
+    """
+    UvicornWorker on uvloop/httptools with WebSocket permessage-deflate disabled.
+
+    The app is almost entirely socket I/O, so the libuv-backed loop pays off
+    on every receive/send. Nearly every frame is audio (base64 or raw PCM),
+    which does not compress, so deflate only costs CPU on both ends. Access
+    logging is off: the handful of HTTP routes don't need it and it is not
+    free under sustained load.
+    """
+
+    CONFIG_KWARGS = {
+        **UvicornWorker.CONFIG_KWARGS,
+        "loop": "uvloop",
+        "http": "httptools",
+        "ws": "websockets",
+        "ws_per_message_deflate": False,
+        "access_log": False,
+    }